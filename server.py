@@ -5,238 +5,560 @@ LUMINA Media Downloader - Local Server with yt-dlp Backend
 """
 
 import os
+import contextlib
+import datetime
+import errno
+import hashlib
+import importlib
+import importlib.util
 import json
+import mimetypes
+import queue
 import subprocess
 import re
+import selectors
+import signal
+import socket
+import stat
+import time
 import uuid
-from http.server import HTTPServer, SimpleHTTPRequestHandler
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import HTTPServer, SimpleHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
+from urllib.parse import unquote, urlsplit, urlunsplit
 import threading
 import webbrowser
-import time
 import sys
 
+# Модуль yt-dlp импортируется в check_yt_dlp() - после установки/обновления
+yt_dlp = None
+
+# orjson (если установлен) быстрее стандартного json и сразу возвращает bytes
+try:
+    import orjson
+    json_dumps = orjson.dumps
+    json_loads = orjson.loads
+except ImportError:
+    def json_dumps(data):
+        return json.dumps(data).encode('utf-8')
+    json_loads = json.loads
+
 # Папка для скачивания видео
 DOWNLOADS_DIR = Path(__file__).parent / 'downloads'
 DOWNLOADS_DIR.mkdir(exist_ok=True)
+DOWNLOADS_PREFIX = '/downloads/'
 
+# Статика (index.html и т.п.) держится в памяти: путь -> (содержимое, mtime, ETag, MIME)
+STATIC_DIR = Path(__file__).parent
+STATIC_EXTENSIONS = ('.html', '.js', '.css', '.png', '.svg', '.ico')
+STATIC_CACHE = {}
 
-def check_yt_dlp():
-    """Проверка наличия yt-dlp, установка/обновление если необходимо"""
-    try:
-        result = subprocess.run(['yt-dlp', '--version'], capture_output=True, check=True, text=True)
-        version = result.stdout.strip()
-        print(f"[INFO] yt-dlp уже установлен: {version}")
-        
-        # Обновляем yt-dlp до последней версии (YouTube часто требует свежую версию)
-        print("[INFO] Обновляем yt-dlp до последней версии...")
-        subprocess.run([sys.executable, '-m', 'pip', 'install', '--upgrade', 'yt-dlp', '-q'], check=False)
-        
+# Регулярные выражения для разбора запросов - компилируются один раз при импорте
+# Имя файла в downloads: UUID + расширение от yt-dlp (mp4, webm, m4a, unknown_video...)
+FNAME_RE = re.compile(r'[A-Fa-f0-9]{32}\.[a-z0-9_]{1,16}')
+RANGE_RE = re.compile(r'bytes=(\d*)-(\d*)')
+KEEP_ALIVE_RE = re.compile(r'timeout=(\d+)')
+
+# Размер блока при потоковой отправке файлов (память не растет с размером видео)
+CHUNK_SIZE = 1024 * 1024
+
+# Ошибки os.sendfile, после которых можно перейти на обычное копирование:
+# sendfile не поддерживается для этого сокета/файла или системы
+SENDFILE_UNSUPPORTED = {errno.EINVAL, errno.ENOTSOCK, errno.ENOSYS, errno.EOPNOTSUPP}
+
+# Опции yt-dlp: лучшее видео + аудио = наилучшее качество для YouTube
+YDL_OPTIONS = {
+    'format': 'bestvideo+bestaudio/best',  # Лучшее видео + аудио, в крайнем случае best
+    'quiet': True,  # Меньше вывода
+    'no_warnings': True,
+    'noprogress': True,
+    'noplaylist': True,  # Только одно видео, даже если в ссылке есть плейлист
+    'nopart': True,  # Не создавать .part файлы
+    'socket_timeout': 30,
+    'merge_output_format': 'mp4',  # Объединяем в mp4
+    'updatetime': False,  # mtime = время скачивания (по нему sweep_downloads удаляет старые файлы)
+}
+
+# Пул заранее созданных YoutubeDL: экстракторы и конфиг загружаются один раз при старте.
+# Экземпляр YoutubeDL не потокобезопасен, поэтому каждый запрос берет свой из очереди
+YDL_POOL_SIZE = 4
+YDL_POOL = queue.Queue()
+
+# Скачивание идет в отдельном daemon-потоке, а обработчик ждет его не дольше
+# DOWNLOAD_TIMEOUT и отвечает 504. Зависший yt-dlp прервать нельзя - он держит экземпляр
+# пула до конца, но клиенты не висят вечно, а CTRL+C не ждет его завершения
+DOWNLOAD_TIMEOUT = 600  # 10 минут для скачивания
+
+# Удаление скачанных файлов в фоне: unlink не задерживает закрытие ответа
+CLEANUP = ThreadPoolExecutor(max_workers=2)
+
+# Файлы, которые клиент так и не забрал, удаляются через час (проверка раз в 10 минут)
+CLEANUP_MAX_AGE = 60 * 60
+CLEANUP_INTERVAL = 10 * 60
+
+# Сколько секунд держать keep-alive соединение открытым без запросов
+KEEP_ALIVE_TIMEOUT = 60
+
+# Сколько клиентов еще должны забрать файл (одно скачивание на несколько запросов).
+# Решение "последний клиент - удалить" принимается под DOWNLOAD_REFS_LOCK
+DOWNLOAD_REFS = {}
+DOWNLOAD_REFS_LOCK = threading.Lock()
+
+# Скачивания в процессе: canonical_url -> {'future': Future, 'waiters': число ожидающих}
+INFLIGHT = {}
+INFLIGHT_LOCK = threading.Lock()
+
+
+def forget_download_refs(filename):
+    """Забыть счетчик клиентов удаленного файла"""
+    with DOWNLOAD_REFS_LOCK:
+        DOWNLOAD_REFS.pop(filename, None)
+
+
+def add_download_refs(filename, count):
+    """Файл заберут count клиентов - удалять только после последнего"""
+    with DOWNLOAD_REFS_LOCK:
+        DOWNLOAD_REFS[filename] = DOWNLOAD_REFS.get(filename, 0) + count
+
+
+def release_download_ref(filename):
+    """Клиент забрал файл; True - больше никто не ждет и файл можно удалить"""
+    with DOWNLOAD_REFS_LOCK:
+        refs = DOWNLOAD_REFS.get(filename, 1) - 1
+        if refs > 0:
+            DOWNLOAD_REFS[filename] = refs
+            return False
+        DOWNLOAD_REFS.pop(filename, None)
         return True
-    except (subprocess.CalledProcessError, FileNotFoundError):
+
+
+def forget_inflight(key, inflight):
+    """Убрать скачивание из INFLIGHT (если его еще не заменило новое); возвращает число ожидавших"""
+    with INFLIGHT_LOCK:
+        if INFLIGHT.get(key) is inflight:
+            del INFLIGHT[key]
+        return inflight['waiters']
+
+
+def canonical_url(url):
+    """Ключ для объединения одинаковых запросов: без пробелов и #фрагмента, схема и хост в нижнем регистре"""
+    parts = urlsplit(url.strip())
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, parts.query, ''))
+
+
+def safe_unlink(filepath):
+    """Удаление файла из downloads (вызывается из фонового потока)"""
+    try:
+        os.remove(filepath)
+        forget_download_refs(filepath.name)
+        print(f"[CLEANUP] Удален файл: {filepath.name}")
+    except FileNotFoundError:
+        forget_download_refs(filepath.name)
+    except Exception as e:
+        print(f"[CLEANUP] Ошибка при удалении: {e}")
+
+
+def sweep_downloads():
+    """Удаление файлов, которые так и не забрали, и планирование следующей проверки"""
+    cutoff = time.time() - CLEANUP_MAX_AGE
+    try:
+        for filepath in DOWNLOADS_DIR.iterdir():
+            try:
+                if filepath.is_file() and filepath.stat().st_mtime < cutoff:
+                    CLEANUP.submit(safe_unlink, filepath)
+            except OSError:
+                pass
+    finally:
+        schedule_sweep()
+
+
+def schedule_sweep():
+    """Запуск sweep_downloads через CLEANUP_INTERVAL секунд"""
+    timer = threading.Timer(CLEANUP_INTERVAL, sweep_downloads)
+    timer.daemon = True
+    timer.start()
+
+
+def load_static_assets(*_):
+    """Загрузка статики из папки скрипта в STATIC_CACHE (при запуске и по SIGHUP)"""
+    global STATIC_CACHE
+    cache = {}
+    for filepath in STATIC_DIR.iterdir():
+        if filepath.suffix.lower() not in STATIC_EXTENSIONS or not filepath.is_file():
+            continue
+        try:
+            body = filepath.read_bytes()
+            mtime = filepath.stat().st_mtime
+        except OSError as e:
+            print(f"[STATIC] Ошибка чтения {filepath.name}: {e}")
+            continue
+        etag = f'"{hashlib.md5(body).hexdigest()}"'
+        mime = mimetypes.guess_type(filepath.name)[0] or 'application/octet-stream'
+        cache[f'/{filepath.name}'] = (body, mtime, etag, mime)
+    # Замена словаря целиком - потоки обработчиков не видят его наполовину заполненным
+    STATIC_CACHE = cache
+    print(f"[STATIC] В памяти файлов: {len(cache)}")
+
+
+def check_yt_dlp(update=False):
+    """Проверка наличия yt-dlp, установка (и обновление с флагом --update)"""
+    global yt_dlp
+    if importlib.util.find_spec('yt_dlp') is not None:
+        print("[INFO] yt-dlp уже установлен")
+        if update:
+            # Обновляем yt-dlp до последней версии (YouTube часто требует свежую версию).
+            # Обновление - до импорта, чтобы не смешать в памяти модули разных версий
+            print("[INFO] Обновляем yt-dlp до последней версии...")
+            subprocess.run([sys.executable, '-m', 'pip', 'install', '--upgrade', 'yt-dlp', '-q'], check=False)
+            importlib.invalidate_caches()
+    else:
         print("[INFO] Установка yt-dlp...")
         try:
             subprocess.run([sys.executable, '-m', 'pip', 'install', 'yt-dlp', '-q'], check=True)
             print("[SUCCESS] yt-dlp успешно установлен")
-            return True
         except subprocess.CalledProcessError:
             print("[ERROR] Не удалось установить yt-dlp")
             return False
+        importlib.invalidate_caches()
+    
+    try:
+        yt_dlp = importlib.import_module('yt_dlp')
+    except ImportError:
+        print("[ERROR] Не удалось импортировать yt-dlp")
+        return False
+    # Версию берем из самого модуля: у копии без dist-info (исходники, zipapp)
+    # importlib.metadata ее не знает
+    print(f"[INFO] yt-dlp версия: {yt_dlp.version.__version__}")
+    return True
+
+
+def init_ydl_pool(size=YDL_POOL_SIZE):
+    """Создание пула YoutubeDL (после check_yt_dlp)"""
+    for _ in range(size):
+        YDL_POOL.put(yt_dlp.YoutubeDL(dict(YDL_OPTIONS)))
+
+
+@contextlib.contextmanager
+def borrow_ydl(outtmpl):
+    """Взять YoutubeDL из пула с шаблоном имени файла для текущего запроса"""
+    ydl = YDL_POOL.get()
+    try:
+        ydl.params['outtmpl']['default'] = outtmpl
+        yield ydl
+    finally:
+        YDL_POOL.put(ydl)
 
 
 class LUMINARequestHandler(SimpleHTTPRequestHandler):
     """Обработчик HTTP запросов с поддержкой yt-dlp скачивания"""
 
+    # HTTP/1.1: браузер забирает страницу, API и видео по одному соединению
+    protocol_version = 'HTTP/1.1'
+    timeout = KEEP_ALIVE_TIMEOUT
+
+    def handle_one_request(self):
+        """Ожидание следующего запроса - с таймаутом Keep-Alive от клиента"""
+        self.connection.settimeout(getattr(self, 'keep_alive_timeout', KEEP_ALIVE_TIMEOUT))
+        super().handle_one_request()
+
+    def parse_request(self):
+        """Разбор запроса с учетом Keep-Alive: timeout= от клиента"""
+        # timeout= от клиента - только время простоя между запросами. Заголовки и ответ
+        # (в том числе паузы при отдаче файла) ограничены KEEP_ALIVE_TIMEOUT
+        self.connection.settimeout(KEEP_ALIVE_TIMEOUT)
+        if not super().parse_request():
+            return False
+        self.keep_alive_timeout = KEEP_ALIVE_TIMEOUT
+        match = KEEP_ALIVE_RE.search(self.headers.get('Keep-Alive', ''))
+        if match:
+            self.keep_alive_timeout = max(1, min(int(match.group(1)), KEEP_ALIVE_TIMEOUT))
+        return True
+
+    # Маршруты GET: ключ - путь до второго '/' (например '/downloads/'), остальное - статика
+    GET_ROUTES = {
+        '/': 'handle_index',
+        DOWNLOADS_PREFIX: 'handle_downloads_route',
+    }
+
+    # Маршруты POST: точное совпадение пути
+    POST_ROUTES = {
+        '/api/download': 'handle_yt_dlp_download',
+    }
+
     def do_GET(self):
         """Обработка GET запросов"""
-        if self.path == '/':
-            self.path = '/index.html'
-        elif self.path.startswith('/downloads/'):
-            # Скачивание файла из папки downloads
-            filename = self.path.replace('/downloads/', '')
-            filepath = DOWNLOADS_DIR / filename
-            
-            if filepath.exists() and filepath.is_file():
-                self.send_response(200)
-                self.send_header('Content-type', 'video/mp4')
-                self.send_header('Content-Disposition', f'attachment; filename="{filename}"')
-                self.send_header('Content-Length', os.path.getsize(filepath))
-                self.end_headers()
-                
-                with open(filepath, 'rb') as f:
-                    self.wfile.write(f.read())
-                
-                # Удаляем файл после скачивания
-                try:
-                    os.remove(filepath)
-                    print(f"[CLEANUP] Удален файл: {filename}")
-                except Exception as e:
-                    print(f"[CLEANUP] Ошибка при удалении: {e}")
-                return
-            else:
+        path = self.path.split('?', 1)[0]
+        head, sep, _ = path[1:].partition('/')
+        route = self.GET_ROUTES.get(f'/{head}{sep}')
+        if route:
+            return getattr(self, route)(path)
+        if self.send_static(path):
+            return
+        return super().do_GET()
+
+    def handle_index(self, path):
+        """Главная страница"""
+        if self.send_static('/index.html'):
+            return
+        self.path = '/index.html'
+        return super().do_GET()
+
+    def send_static(self, path):
+        """Отдача статики из STATIC_CACHE; False - файла нет в кэше"""
+        asset = STATIC_CACHE.get(path)
+        if asset is None:
+            return False
+        body, mtime, etag, mime = asset
+        
+        if self.is_not_modified(etag, mtime):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return True
+        
+        self.send_response(200)
+        self.send_header('Content-Type', mime)
+        self.send_header('Content-Length', len(body))
+        self.send_header('Last-Modified', formatdate(mtime, usegmt=True))
+        self.send_header('ETag', etag)
+        # Имена файлов без хэша - браузер каждый раз сверяет ETag и получает 304
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_body_with_headers(body)
+        return True
+
+    def handle_downloads_route(self, path):
+        """Скачивание файла из папки downloads"""
+        filename = unquote(path[len(DOWNLOADS_PREFIX):])
+        # Только имена, которые выдает сервер (UUID + расширение): без '..', подпапок и абсолютных путей
+        if not FNAME_RE.fullmatch(filename):
+            self.send_error(404)
+            return
+        self.handle_file_download(filename, DOWNLOADS_DIR / filename)
+
+    def handle_file_download(self, filename, filepath):
+        """Отдача файла из папки downloads с последующим удалением"""
+        # Один open на весь запрос: размер, Last-Modified и ETag берем из fstat
+        # открытого файла - заголовки точно соответствуют отправляемым байтам.
+        # Отдача идет без блокировки: параллельные Range-запросы (перемотка в <video>,
+        # докачка) к одному файлу не ждут друг друга
+        try:
+            # Без буферизации Python - блоки читаем сами
+            f = open(filepath, 'rb', buffering=0)
+        except OSError:
+            self.send_error(404)
+            return
+        
+        with f:
+            st = os.fstat(f.fileno())
+            if not stat.S_ISREG(st.st_mode):
                 self.send_error(404)
                 return
+            complete = self.send_download(f, filename, st)
         
-        return super().do_GET()
+        # Удаляем только после отдачи целиком: части (перемотка, докачка, чтение
+        # хвоста плеером) означают, что файл еще понадобится
+        if not complete:
+            return
+        
+        # Удаляем файл после скачивания - в фоне, чтобы не задерживать ответ.
+        # release_download_ref атомарно решает, что этот клиент последний
+        if release_download_ref(filename):
+            CLEANUP.submit(safe_unlink, filepath)
+
+    def send_download(self, f, filename, st):
+        """Ответ на GET открытого файла (304/416/206/200); True - файл отдан целиком"""
+        last_modified = formatdate(st.st_mtime, usegmt=True)
+        etag = '"%x-%x"' % (int(st.st_mtime), st.st_size)
+        if self.is_not_modified(etag, st.st_mtime):
+            self.send_response(304)
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', last_modified)
+            self.end_headers()
+            return False
+        
+        # Range: перемотка в <video> и докачка без повторной передачи
+        byte_range = None
+        if_range = self.headers.get('If-Range')
+        if if_range is None or if_range.strip() in (etag, last_modified):
+            byte_range = self.parse_range(st.st_size)
+        if byte_range == 'invalid':
+            self.send_response(416)
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Content-Range', f'bytes */{st.st_size}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return False
+        start, end = byte_range or (0, st.st_size - 1)
+        length = end - start + 1
+        
+        # TCP_CORK: заголовки и блоки файла уходят полными сегментами
+        self.set_tcp_cork(True)
+        try:
+            if byte_range:
+                self.send_response(206)
+                self.send_header('Content-Range', f'bytes {start}-{end}/{st.st_size}')
+            else:
+                self.send_response(200)
+            self.send_header('Content-type', 'video/mp4')
+            self.send_header('Content-Disposition', f'attachment; filename="{filename}"')
+            self.send_header('Content-Length', length)
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Last-Modified', last_modified)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            self.send_file_body(f, start, length)
+        finally:
+            self.set_tcp_cork(False)
+        return length == st.st_size
+
+    def parse_range(self, size):
+        """Разбор заголовка Range: (start, end), None - отдать целиком, 'invalid' - ответ 416"""
+        header = self.headers.get('Range')
+        if not header:
+            return None
+        match = RANGE_RE.fullmatch(header.strip())
+        if not match or not (match.group(1) or match.group(2)):
+            # Несколько диапазонов и прочие формы не поддерживаем - отдаем весь файл
+            return None
+        if not match.group(1):
+            # bytes=-N: последние N байт
+            suffix = int(match.group(2))
+            if suffix == 0:
+                return 'invalid'
+            return max(0, size - suffix), size - 1
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) else size - 1
+        if start >= size or end < start:
+            return 'invalid'
+        return start, min(end, size - 1)
+
+    def is_not_modified(self, etag, mtime):
+        """Проверка If-None-Match / If-Modified-Since - можно ответить 304"""
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match:
+            if if_none_match.strip() == '*':
+                return True
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            return etag in tags or f'W/{etag}' in tags
+        
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since:
+            try:
+                since = parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                return False
+            if since.tzinfo is None:
+                since = since.replace(tzinfo=datetime.timezone.utc)
+            return int(mtime) <= since.timestamp()
+        return False
+
+    def send_file_body(self, f, offset, count):
+        """Отправка файла клиенту через os.sendfile (копирование в ядре, без чтения в память)"""
+        # Сбрасываем буфер, чтобы заголовки ушли в сокет раньше тела
+        self.wfile.flush()
+        out_fd = self.wfile.fileno()
+        in_fd = f.fileno()
+        sent_total = 0
+        selector = None
+        try:
+            while count > 0:
+                try:
+                    sent = os.sendfile(out_fd, in_fd, offset, count)
+                except BlockingIOError:
+                    # Сокет с таймаутом неблокирующий - ждем, пока освободится буфер отправки
+                    if selector is None:
+                        selector = selectors.DefaultSelector()
+                        selector.register(out_fd, selectors.EVENT_WRITE)
+                    if not selector.select(self.connection.gettimeout()):
+                        raise socket.timeout('timed out')
+                    continue
+                if sent == 0:
+                    break
+                offset += sent
+                count -= sent
+                sent_total += sent
+        except (AttributeError, OSError) as e:
+            # sendfile недоступен (Windows) или не поддерживается для этого сокета -
+            # переходим на обычное копирование, если еще ничего не отправлено.
+            # Обрыв соединения и таймаут клиента пробрасываем: повтор не поможет
+            if sent_total or (isinstance(e, OSError) and e.errno not in SENDFILE_UNSUPPORTED):
+                raise
+            f.seek(offset)
+            # Один буфер на всю отдачу: readinto без новых bytes на каждый блок
+            buf = memoryview(bytearray(min(CHUNK_SIZE, count)))
+            while count > 0:
+                n = f.readinto(buf[:min(len(buf), count)])
+                if not n:
+                    break
+                self.wfile.write(buf[:n])
+                count -= n
+        finally:
+            if selector is not None:
+                selector.close()
+
+    def set_tcp_cork(self, enabled):
+        """Включить/выключить TCP_CORK (только Linux)"""
+        if not hasattr(socket, 'TCP_CORK'):
+            return
+        try:
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, int(enabled))
+        except OSError:
+            pass
 
     def do_POST(self):
         """Обработка POST запросов к API"""
-        if self.path == '/api/download':
-            self.handle_yt_dlp_download()
+        route = self.POST_ROUTES.get(self.path)
+        if route:
+            getattr(self, route)()
         else:
             self.send_error(404)
 
     def handle_yt_dlp_download(self):
-        """Скачивание видео через yt-dlp"""
+        """Скачивание видео через yt-dlp в downloads, ответ - JSON с метаданными и ссылкой"""
         content_length = int(self.headers.get('Content-Length', 0))
         body = self.rfile.read(content_length)
         
         try:
             # Парсим JSON тело запроса
-            data = json.loads(body.decode('utf-8'))
+            data = json_loads(body)
             url = data.get('url')
             
             if not url:
                 self.send_json_response({'error': 'URL not provided'}, 400)
                 return
-
+            
             print(f"[YT-DLP] Processing: {url}")
             
-            # Сначала получаем информацию о видео
+            # Одинаковые одновременные запросы ждут первый, а не качают видео заново
+            key = canonical_url(url)
+            with INFLIGHT_LOCK:
+                inflight = INFLIGHT.get(key)
+                if inflight is None:
+                    inflight = INFLIGHT[key] = {'future': Future(), 'waiters': 0}
+                    threading.Thread(
+                        target=self.run_inflight_download, args=(key, url, inflight), daemon=True
+                    ).start()
+                else:
+                    inflight['waiters'] += 1
+                    print(f"[YT-DLP] Waiting for in-flight download: {url}")
+            
             try:
-                info_result = subprocess.run(
-                    ['yt-dlp', '-j', '--no-warnings', url],
-                    capture_output=True,
-                    text=True,
-                    timeout=10
-                )
-                
-                if info_result.returncode != 0:
-                    error_msg = info_result.stderr or 'Failed to get video info'
-                    print(f"[YT-DLP] Error: {error_msg}")
-                    self.send_json_response({
-                        'status': 'error',
-                        'error': error_msg
-                    }, 400)
-                    return
-                
-                video_info = json.loads(info_result.stdout)
-                
-                # Подготовляем метаданные
-                title = video_info.get('title', 'video')
-                duration = video_info.get('duration', 0)
-                thumbnail = video_info.get('thumbnail', '')
-                ext = video_info.get('ext', 'mp4')
-                
-                # Генерируем безопасное имя файла (UUID + расширение)
-                # Используем UUID чтобы избежать проблем с кириллицей и спецсимволами
-                safe_filename = f"{uuid.uuid4().hex}.{ext}"
-                filename = safe_filename  # Это имя для ответа клиенту
-                filepath = DOWNLOADS_DIR / safe_filename
-                
-                print(f"[YT-DLP] Title: {title}")
-                print(f"[YT-DLP] Duration: {duration}s")
-                print(f"[YT-DLP] Downloading to: {filepath}")
-                
-                # Скачиваем видео с лучшими опциями для YouTube
-                # Формат: bestvideo + bestaudio = наилучшее качество
-                download_result = subprocess.run(
-                    [
-                        'yt-dlp',
-                        '-f', 'bestvideo+bestaudio/best',  # Лучшее видео + аудио, в текение best
-                        '-o', str(filepath),
-                        '--no-warnings',
-                        '--socket-timeout', '30',
-                        '--no-part',  # Не создавать .part файлы
-                        '--quiet',  # Меньше вывода
-                        '--merge-output-format', 'mp4',  # Объединяем в mp4
-                        url
-                    ],
-                    capture_output=True,
-                    text=True,
-                    timeout=600  # 10 минут для скачивания
-                )
-                
-                print(f"[YT-DLP] Return code: {download_result.returncode}")
-                if download_result.stderr:
-                    print(f"[YT-DLP] STDERR: {download_result.stderr[:200]}")
-                if download_result.stdout:
-                    print(f"[YT-DLP] STDOUT: {download_result.stdout[:200]}")
-                
-                if download_result.returncode != 0:
-                    error_msg = download_result.stderr or download_result.stdout or 'Download failed'
-                    print(f"[YT-DLP] Download error: {error_msg}")
-                    self.send_json_response({
-                        'status': 'error',
-                        'error': error_msg
-                    }, 400)
-                    return
-                
-                # Даем небольшую задержку чтобы файл полностью записался
-                time.sleep(1)
-                
-                # Проверяем что файл существует
-                if not filepath.exists():
-                    print(f"[YT-DLP] File not found after download: {filepath}")
-                    self.send_json_response({
-                        'status': 'error',
-                        'error': 'File was not created'
-                    }, 400)
-                    return
-                
-                # Проверяем размер несколько раз (может быть задержка записи)
-                file_size = os.path.getsize(filepath)
-                for attempt in range(3):
-                    if file_size > 0:
-                        break
-                    print(f"[YT-DLP] File size check attempt {attempt + 1}: {file_size} bytes, retrying...")
-                    time.sleep(0.5)
-                    file_size = os.path.getsize(filepath)
-                
-                # Проверяем что файл не пустой
-                if file_size == 0:
-                    try:
-                        filepath.unlink()  # Удаляем пустой файл
-                    except:
-                        pass
-                    print(f"[YT-DLP] Download failed: file is empty")
-                    self.send_json_response({
-                        'status': 'error',
-                        'error': 'Downloaded file is empty. The video might be restricted or unavailable. Try another link.'
-                    }, 400)
-                    return
-                
-                print(f"[YT-DLP] Download complete! Size: {file_size} bytes")
-                
-                # Формируем ответ с информацией о видео и ссылкой на скачивание
-                response_data = {
-                    'status': 'success',
-                    'title': title,
-                    'duration': duration,
-                    'thumbnail': thumbnail,
-                    'filesize': file_size,
-                    'filename': filename,
-                    'url': f'/downloads/{filename}',
-                    'desc': f'Duration: {self.format_time(duration)}'
-                }
-                
-                self.send_json_response(response_data, 200)
-                
-            except subprocess.TimeoutExpired:
-                error_msg = 'Download timeout (file too large?)'
-                print(f"[YT-DLP] Error: {error_msg}")
-                self.send_json_response({
-                    'status': 'error',
-                    'error': error_msg
-                }, 504)
-            except json.JSONDecodeError:
-                error_msg = 'Invalid video info response'
-                print(f"[YT-DLP] Error: {error_msg}")
-                self.send_json_response({
-                    'status': 'error',
-                    'error': error_msg
-                }, 400)
-                
+                response_data, status_code = inflight['future'].result(timeout=DOWNLOAD_TIMEOUT)
+            except FutureTimeoutError:
+                # Новые запросы этого URL не должны присоединяться к зависшему скачиванию
+                forget_inflight(key, inflight)
+                raise
+            self.send_json_response(response_data, status_code)
+        
+        except FutureTimeoutError:
+            error_msg = 'Download timeout (file too large?)'
+            print(f"[YT-DLP] Error: {error_msg}")
+            self.send_json_response({
+                'status': 'error',
+                'error': error_msg
+            }, 504)
         except json.JSONDecodeError:
             error_msg = 'Invalid JSON in request'
             print(f"[YT-DLP] Error: {error_msg}")
@@ -252,6 +574,88 @@ class LUMINARequestHandler(SimpleHTTPRequestHandler):
                 'error': error_msg
             }, 500)
 
+    def run_inflight_download(self, key, url, inflight):
+        """Одно скачивание для всех одновременных запросов одного URL (в фоновом потоке)"""
+        try:
+            response_data, status_code = self.run_yt_dlp_download(url)
+        except Exception as e:
+            forget_inflight(key, inflight)
+            inflight['future'].set_exception(e)
+            return
+        waiters = forget_inflight(key, inflight)
+        if status_code == 200:
+            # Файл удаляется только после того, как его заберут все ожидавшие
+            add_download_refs(response_data['filename'], 1 + waiters)
+        inflight['future'].set_result((response_data, status_code))
+
+    def run_yt_dlp_download(self, url):
+        """Скачивание видео в downloads, возвращает (данные для JSON ответа, HTTP статус)"""
+        # Генерируем безопасное имя файла (UUID + расширение, которое выберет yt-dlp)
+        # Используем UUID чтобы избежать проблем с кириллицей и спецсимволами
+        file_id = uuid.uuid4().hex
+        
+        try:
+            # yt-dlp работает в этом же процессе: без запуска интерпретатора и JSON через pipe.
+            # extract_info возвращается только после того, как файл полностью записан и закрыт
+            with borrow_ydl(str(DOWNLOADS_DIR / f'{file_id}.%(ext)s')) as ydl:
+                video_info = ydl.extract_info(url, download=True)
+        except yt_dlp.utils.DownloadError as e:
+            error_msg = str(e) or 'Download failed'
+            print(f"[YT-DLP] Download error: {error_msg}")
+            return {
+                'status': 'error',
+                'error': error_msg
+            }, 400
+        
+        # Подготовляем метаданные
+        title = video_info.get('title', 'video')
+        duration = video_info.get('duration', 0)
+        thumbnail = video_info.get('thumbnail', '')
+        
+        requested = video_info.get('requested_downloads') or [{}]
+        filepath = Path(requested[0].get('filepath') or DOWNLOADS_DIR / f'{file_id}.mp4')
+        filename = filepath.name  # Это имя для ответа клиенту
+        
+        print(f"[YT-DLP] Title: {title}")
+        print(f"[YT-DLP] Duration: {duration}s")
+        print(f"[YT-DLP] Downloaded to: {filepath}")
+        
+        # Проверяем что файл существует (один stat и для размера)
+        try:
+            file_size = filepath.stat().st_size
+        except OSError:
+            print(f"[YT-DLP] File not found after download: {filepath}")
+            return {
+                'status': 'error',
+                'error': 'File was not created'
+            }, 400
+        
+        # Проверяем что файл не пустой
+        if file_size == 0:
+            try:
+                filepath.unlink()  # Удаляем пустой файл
+            except:
+                pass
+            print(f"[YT-DLP] Download failed: file is empty")
+            return {
+                'status': 'error',
+                'error': 'Downloaded file is empty. The video might be restricted or unavailable. Try another link.'
+            }, 400
+        
+        print(f"[YT-DLP] Download complete! Size: {file_size} bytes")
+        
+        # Формируем ответ с информацией о видео и ссылкой на скачивание
+        return {
+            'status': 'success',
+            'title': title,
+            'duration': duration,
+            'thumbnail': thumbnail,
+            'filesize': file_size,
+            'filename': filename,
+            'url': f'{DOWNLOADS_PREFIX}{filename}',
+            'desc': f'Duration: {self.format_time(duration)}'
+        }, 200
+
     @staticmethod
     def format_time(seconds):
         """Форматирование времени в HH:MM:SS"""
@@ -265,21 +669,39 @@ class LUMINARequestHandler(SimpleHTTPRequestHandler):
         return f"{minutes}:{secs:02d}"
 
     def send_json_response(self, data, status_code=200):
-        """Отправить JSON ответ"""
-        response = json.dumps(data).encode('utf-8')
+        """Отправить JSON ответ (заголовки и тело - одной записью в сокет)"""
+        response = json_dumps(data)
         self.send_response(status_code)
         self.send_header('Content-Type', 'application/json')
         self.send_header('Content-Length', len(response))
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.end_headers()
-        self.wfile.write(response)
+        self.send_body_with_headers(response)
+
+    def send_body_with_headers(self, body):
+        """Завершить заголовки и отправить тело вместе с ними"""
+        self.send_common_headers()
+        if self.request_version == 'HTTP/0.9':
+            # В HTTP/0.9 нет заголовков (и буфера под них) - только тело
+            self.wfile.write(body)
+            return
+        # Вместо end_headers() + write(): пустая строка и тело дописываются
+        # в буфер заголовков, и весь ответ уходит одним системным вызовом
+        self._headers_buffer.append(b'\r\n' + body)
+        self.flush_headers()
 
     def end_headers(self):
-        """Добавить CORS заголовки"""
+        """Добавить CORS и keep-alive заголовки"""
+        self.send_common_headers()
+        super().end_headers()
+
+    def send_common_headers(self):
+        """CORS и keep-alive заголовки для всех ответов"""
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
         self.send_header('Access-Control-Allow-Headers', 'Content-Type')
-        super().end_headers()
+        if not self.close_connection:
+            self.send_header('Connection', 'keep-alive')
+            timeout = getattr(self, 'keep_alive_timeout', KEEP_ALIVE_TIMEOUT)
+            self.send_header('Keep-Alive', f'timeout={timeout}')
 
     def do_OPTIONS(self):
         """Обработка CORS preflight запросов"""
@@ -287,6 +709,8 @@ class LUMINARequestHandler(SimpleHTTPRequestHandler):
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
         self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        # В HTTP/1.1 без Content-Length клиент ждал бы тело до закрытия соединения
+        self.send_header('Content-Length', '0')
         self.end_headers()
 
     def log_message(self, format, *args):
@@ -294,20 +718,28 @@ class LUMINARequestHandler(SimpleHTTPRequestHandler):
         print(f"[HTTP] {format % args}")
 
 
-def start_server(port=8000):
+def start_server(port=8000, update=False):
     """Запуск HTTP сервера"""
     # Переходим в директорию скрипта
     script_dir = os.path.dirname(os.path.abspath(__file__))
     os.chdir(script_dir)
     
     # Проверяем yt-dlp
-    if not check_yt_dlp():
+    if not check_yt_dlp(update):
         print("\n[ERROR] yt-dlp не установлен. Установите его: pip install yt-dlp")
         input("Нажмите Enter для выхода...")
         sys.exit(1)
-    
+    init_ydl_pool()
+    sweep_downloads()
+    load_static_assets()
+    # Перечитать статику без перезапуска: kill -HUP <pid> (нет в Windows)
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, load_static_assets)
+
     server_address = ('', port)
-    httpd = HTTPServer(server_address, LUMINARequestHandler)
+    httpd = ThreadingHTTPServer(server_address, LUMINARequestHandler)
+    # Потоки запросов не должны мешать выходу по CTRL+C
+    httpd.daemon_threads = True
     
     print("\n" + "=" * 70)
     print("🚀 LUMINA Media Downloader Server (yt-dlp powered)")
@@ -331,9 +763,10 @@ def start_server(port=8000):
 
 
 if __name__ == '__main__':
-    # Порт можно изменить аргументом командной строки
-    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
-    start_server(port)
+    # Порт можно изменить аргументом командной строки, --update обновляет yt-dlp перед запуском
+    args = [arg for arg in sys.argv[1:] if arg != '--update']
+    port = int(args[0]) if args else 8000
+    start_server(port, update='--update' in sys.argv[1:])
     """Обработчик HTTP запросов с поддержкой API proxy"""
 
     def do_GET(self):